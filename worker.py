@@ -2,10 +2,12 @@ import os
 import time
 import json
 import base64
+import orjson
 import requests
 import traceback
 from urllib.parse import urlparse
-from datetime import datetime
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric import padding
@@ -25,9 +27,18 @@ MIN_MOVE = float(os.getenv("MIN_MOVE", "1.0"))
 # How often (in seconds) to write the big cfp_markets/current doc
 WRITE_INTERVAL = float(os.getenv("WRITE_INTERVAL", "60"))  # default: 60s
 
+# How often (in seconds) to poll Kalshi for market prices
+POLL_INTERVAL = float(os.getenv("POLL_INTERVAL", "5"))  # default: 5s
+
+# Upper bound (in seconds) on the exponential backoff after failed polls
+MAX_BACKOFF = float(os.getenv("MAX_BACKOFF", "60"))  # default: 60s
+
 BASE = "https://api.elections.kalshi.com/trade-api/v2"
 CFP_EVENT = "KXNCAAFPLAYOFF-25"
 
+# Path prefix of BASE (e.g. /trade-api/v2), used when signing requests
+BASE_PATH = urlparse(BASE).path
+
 
 # =====================
 # FIRESTORE INIT
@@ -72,6 +83,10 @@ def init_firestore():
 
 db = init_firestore()
 
+# Refs are reused every poll instead of being rebuilt per write
+current_markets_ref = db.collection("cfp_markets").document("current")
+movers_ref = db.collection("movers")
+
 
 # =====================
 # KALSHI CONFIG
@@ -100,32 +115,56 @@ except Exception as e:
     traceback.print_exc()
     raise
 
+# RSA-PSS parameters are fixed, so build them once rather than per request
+PSS_PADDING = padding.PSS(
+    mgf=padding.MGF1(hashes.SHA256()),
+    salt_length=padding.PSS.MAX_LENGTH
+)
+SHA256 = hashes.SHA256()
+_sign = private_key.sign
+
+# One shared session so TCP/TLS connections are reused across polls
+# instead of re-handshaking on every request. 429/503 and Retry-After are
+# left to main()'s backoff rather than retried here with a stale signature.
+session = requests.Session()
+session.mount("https://", HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=32,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.2,
+        status_forcelist=[502, 504],
+        respect_retry_after_header=False,
+        raise_on_status=False
+    )
+))
+
 
 # =====================
 # SIGNED REQUEST
 # =====================
 
-def kalshi_signed_request(method, url, body=None):
-    path = urlparse(url).path
-    timestamp = str(int(time.time() * 1000))
-    message = timestamp + method.upper() + path
+def sign_message(message):
+    """Return the base64 RSA-PSS/SHA-256 signature of `message`."""
+    return base64.b64encode(_sign(message.encode(), PSS_PADDING, SHA256)).decode()
+
+
+def kalshi_signed_request(method, path, body=None):
+    """
+    Send a signed request to Kalshi. `path` is relative to BASE and may
+    include a query string; only the path part is signed.
+    """
+    url = BASE + path
+    timestamp = str(time.time_ns() // 1_000_000)
+    message = timestamp + method.upper() + BASE_PATH + path.split("?", 1)[0]
 
     try:
-        signature_bytes = private_key.sign(
-            message.encode(),
-            padding.PSS(
-                mgf=padding.MGF1(hashes.SHA256()),
-                salt_length=padding.PSS.MAX_LENGTH
-            ),
-            hashes.SHA256()
-        )
+        signature = sign_message(message)
     except Exception as e:
         print("❌ Error signing Kalshi message:", repr(e), flush=True)
         traceback.print_exc()
         return None
 
-    signature = base64.b64encode(signature_bytes).decode()
-
     headers = {
         "KALSHI-ACCESS-KEY": API_KEY,
         "KALSHI-ACCESS-TIMESTAMP": timestamp,
@@ -135,9 +174,9 @@ def kalshi_signed_request(method, url, body=None):
 
     try:
         if method.upper() == "GET":
-            return requests.get(url, headers=headers, timeout=10)
+            return session.get(url, headers=headers, timeout=10)
         else:
-            return requests.post(url, headers=headers, data=json.dumps(body or {}), timeout=10)
+            return session.post(url, headers=headers, data=orjson.dumps(body or {}), timeout=10)
     except requests.exceptions.RequestException as e:
         print("❌ HTTP ERROR talking to Kalshi:", e, flush=True)
         traceback.print_exc()
@@ -148,24 +187,43 @@ def kalshi_signed_request(method, url, body=None):
 # FETCH MARKETS
 # =====================
 
+class KalshiError(Exception):
+    """A market fetch failed; main() backs off before polling again."""
+
+    retry_after = 0.0
+
+
+class KalshiBackoff(KalshiError):
+    """Kalshi asked us to slow down (429/503); carries Retry-After seconds."""
+
+    def __init__(self, status_code, retry_after):
+        super().__init__(f"Kalshi returned {status_code}, Retry-After={retry_after}s")
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
 def fetch_cfp_markets():
-    url = f"{BASE}/markets?event_ticker={CFP_EVENT}&limit=500"
-    print(f"🌐 Fetching markets from {url}", flush=True)
+    path = f"/markets?event_ticker={CFP_EVENT}&limit=1000"
+    print(f"🌐 Fetching markets from {BASE}{path}", flush=True)
 
-    resp = kalshi_signed_request("GET", url)
+    resp = kalshi_signed_request("GET", path)
     if resp is None:
-        print("❌ No response from Kalshi", flush=True)
-        return []
+        raise KalshiError("No response from Kalshi")
+
+    if resp.status_code in (429, 503):
+        try:
+            retry_after = float(resp.headers.get("Retry-After", 0))
+        except ValueError:
+            retry_after = 0.0  # HTTP-date form; fall back to our own backoff
+        raise KalshiBackoff(resp.status_code, retry_after)
 
     try:
-        data = resp.json()
+        data = orjson.loads(resp.content)
     except Exception:
-        print("❌ NON-JSON RESPONSE:", resp.status_code, resp.text[:500], flush=True)
-        return []
+        raise KalshiError(f"NON-JSON RESPONSE: {resp.status_code} {resp.text[:500]}")
 
     if resp.status_code != 200:
-        print("❌ Kalshi API ERROR:", resp.status_code, data, flush=True)
-        return []
+        raise KalshiError(f"Kalshi API ERROR: {resp.status_code} {data}")
 
     markets = data.get("markets", [])
     clean = []
@@ -185,91 +243,62 @@ def fetch_cfp_markets():
 # POLLING + FIRESTORE WRITE
 # =====================
 
-def poll_once(last_prices, last_write_ts):
+def utc_timestamp():
+    """Current UTC time as ISO-8601 with microseconds and a trailing Z."""
+    secs, ns = divmod(time.time_ns(), 1_000_000_000)
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(secs)) + f".{ns // 1000:06d}Z"
+
+
+def log_firestore_error(ts, what, e, note=""):
+    msg = str(e)
+    if "Quota exceeded" in msg or "429" in msg:
+        print(
+            f"{ts} | ⚠️ Firestore quota exceeded on {what} write. "
+            f"{note}Raw error: {repr(e)}",
+            flush=True
+        )
+    else:
+        print(f"❌ Error writing {what} to Firestore:", repr(e), flush=True)
+        traceback.print_exc()
+
+
+def poll_once(last_prices, last_write_ts, last_payload):
     markets = fetch_cfp_markets()
-    ts = datetime.utcnow().isoformat() + "Z"
+    ts = utc_timestamp()
 
     if not markets:
         print(f"{ts} | No markets returned.", flush=True)
-        return last_prices, last_write_ts, 0
+        return last_prices, last_write_ts, last_payload, 0
 
-    # ---- Build payload for current odds doc (ticker tape) ----
+    # ---- Single pass: ticker tape payload + major movers ----
     ticker_payload = []
+    movers = []
     for m in markets:
         ticker = m.get("ticker")
         yesp = m.get("yes_price")
         lastp = m.get("last_price")
-        best_bid = m.get("best_bid")
-        best_ask = m.get("best_ask")
 
         price = yesp if yesp is not None else lastp
         if price is None:
             continue
 
-        prob = None
         try:
-            prob = float(price) / 100.0
+            price = float(price)
         except Exception:
-            pass
+            price = None
 
         ticker_payload.append({
             "ticker": ticker,
             "yes_price": yesp,
             "last_price": lastp,
-            "best_bid": best_bid,
-            "best_ask": best_ask,
-            "probability": prob
+            "best_bid": m.get("best_bid"),
+            "best_ask": m.get("best_ask"),
+            "probability": price / 100.0 if price is not None else None
         })
 
-    # ---- Throttled write of current odds (cfp_markets/current) ----
-    now = time.time()
-    if now - last_write_ts >= WRITE_INTERVAL:
-        try:
-            db.collection("cfp_markets").document("current").set({
-                "timestamp": ts,
-                "event_ticker": CFP_EVENT,
-                "markets": ticker_payload
-            })
-            last_write_ts = now
-            print(
-                f"{ts} | ✅ Wrote {len(ticker_payload)} markets to Firestore "
-                f"(cfp_markets/current) | interval={WRITE_INTERVAL}s",
-                flush=True
-            )
-        except Exception as e:
-            msg = str(e)
-            if "Quota exceeded" in msg or "429" in msg:
-                print(
-                    f"{ts} | ⚠️ Firestore quota exceeded on current-markets write. "
-                    f"Will retry after interval. Raw error: {repr(e)}",
-                    flush=True
-                )
-            else:
-                print("❌ Error writing current markets to Firestore:", repr(e), flush=True)
-                traceback.print_exc()
-    else:
-        print(
-            f"{ts} | ⏭ Skipping Firestore current-markets write; only "
-            f"{now - last_write_ts:.1f}s since last write (interval={WRITE_INTERVAL}s)",
-            flush=True
-        )
-
-    # ---- Detect major movers ----
-    movers = []
-    for m in markets:
-        ticker = m.get("ticker")
-        yesp = m.get("yes_price")
-        lastp = m.get("last_price")
-
-        price = yesp if yesp is not None else lastp
         if price is None:
             continue
 
-        try:
-            price = float(price)
-        except Exception:
-            continue
-
         prev = last_prices.get(ticker)
 
         if prev is None:
@@ -287,31 +316,85 @@ def poll_once(last_prices, last_write_ts):
             })
             last_prices[ticker] = price
 
-    if movers:
-        try:
-            db.collection("movers").document(ts).set({
+    # ---- Throttled write of current odds (cfp_markets/current) ----
+    now = time.time()
+    write_current = now - last_write_ts >= WRITE_INTERVAL
+    payload_changed = ticker_payload != last_payload
+    if not write_current:
+        print(
+            f"{ts} | ⏭ Skipping Firestore current-markets write; only "
+            f"{now - last_write_ts:.1f}s since last write (interval={WRITE_INTERVAL}s)",
+            flush=True
+        )
+
+    if not movers:
+        print(f"{ts} | No movers this tick", flush=True)
+
+    movers_doc = {
+        "timestamp": ts,
+        "event_ticker": CFP_EVENT,
+        "min_move": MIN_MOVE,
+        "count": len(movers),
+        "items": movers
+    }
+
+    # ---- One batched commit for current odds + movers ----
+    if write_current or movers:
+        batch = db.batch()
+        if write_current and payload_changed:
+            batch.set(current_markets_ref, {
                 "timestamp": ts,
                 "event_ticker": CFP_EVENT,
-                "min_move": MIN_MOVE,
-                "count": len(movers),
-                "items": movers
+                "markets": ticker_payload
             })
-            print(f"{ts} | 🚨 Recorded {len(movers)} movers", flush=True)
-        except Exception as e:
-            msg = str(e)
-            if "Quota exceeded" in msg or "429" in msg:
+        elif write_current:
+            # Prices unchanged: only refresh the timestamp so readers can
+            # still tell a quiet market from a stalled worker. merge=True
+            # (not update()) so a deleted doc is recreated, not a NotFound.
+            batch.set(current_markets_ref, {"timestamp": ts}, merge=True)
+        if movers:
+            batch.set(movers_ref.document(ts), movers_doc)
+
+        try:
+            batch.commit()
+            if write_current:
+                last_write_ts = now
+            if write_current and payload_changed:
+                last_payload = ticker_payload
                 print(
-                    f"{ts} | ⚠️ Firestore quota exceeded on movers write. "
-                    f"Raw error: {repr(e)}",
+                    f"{ts} | ✅ Wrote {len(ticker_payload)} markets to Firestore "
+                    f"(cfp_markets/current) | interval={WRITE_INTERVAL}s",
                     flush=True
                 )
+            elif write_current:
+                print(
+                    f"{ts} | 💓 No prices changed; refreshed cfp_markets/current "
+                    f"timestamp only | interval={WRITE_INTERVAL}s",
+                    flush=True
+                )
+            if movers:
+                print(f"{ts} | 🚨 Recorded {len(movers)} movers", flush=True)
+        except Exception as e:
+            if not write_current:
+                log_firestore_error(ts, "movers", e)
             else:
-                print("❌ Error writing movers to Firestore:", repr(e), flush=True)
-                traceback.print_exc()
-    else:
-        print(f"{ts} | No movers this tick", flush=True)
+                log_firestore_error(
+                    ts, "current-markets", e,
+                    "Will retry after interval. " if not movers else
+                    "Current markets will retry after interval; "
+                    "retrying movers on their own. "
+                )
+                # The batch is atomic, so a rejected snapshot also dropped
+                # the movers. last_prices has already advanced past them,
+                # so write them separately rather than lose them.
+                if movers:
+                    try:
+                        movers_ref.document(ts).set(movers_doc)
+                        print(f"{ts} | 🚨 Recorded {len(movers)} movers", flush=True)
+                    except Exception as e:
+                        log_firestore_error(ts, "movers", e)
 
-    return last_prices, last_write_ts, len(movers)
+    return last_prices, last_write_ts, last_payload, len(movers)
 
 
 # =====================
@@ -322,21 +405,45 @@ def main():
     print("🚀 Worker main() starting", flush=True)
     last_prices = {}
     last_write_ts = 0.0  # force an initial write
+    last_payload = None  # markets from the last cfp_markets/current write
 
     print("✅ Worker initialized", flush=True)
     print("   BASE           =", BASE, flush=True)
     print("   EVENT          =", CFP_EVENT, flush=True)
     print("   MIN_MOVE       =", MIN_MOVE, flush=True)
     print("   WRITE_INTERVAL =", WRITE_INTERVAL, "seconds", flush=True)
+    print("   POLL_INTERVAL  =", POLL_INTERVAL, "seconds", flush=True)
+    print("   MAX_BACKOFF    =", MAX_BACKOFF, "seconds", flush=True)
 
+    fail_count = 0
     while True:
+        started = time.monotonic()
+        backoff = 0.0
         try:
-            last_prices, last_write_ts, _ = poll_once(last_prices, last_write_ts)
+            last_prices, last_write_ts, last_payload, _ = poll_once(
+                last_prices, last_write_ts, last_payload
+            )
+            fail_count = 0
+        except KalshiError as e:
+            fail_count += 1
+            backoff = max(e.retry_after, min(MAX_BACKOFF, 2 ** fail_count))
+            print(f"❌ {e}", flush=True)
         except Exception as e:
+            fail_count += 1
+            backoff = min(MAX_BACKOFF, 2 ** fail_count)
             print("❌ ERROR in poller loop:", repr(e), flush=True)
             traceback.print_exc()
 
-        time.sleep(5)
+        # Sleep only for what's left of the interval, so fetch + commit
+        # latency overlaps the wait instead of stacking on top of it.
+        # After a failure, wait at least the backoff.
+        delay = max(backoff, POLL_INTERVAL - (time.monotonic() - started))
+        if fail_count:
+            print(
+                f"⏳ Backing off {delay:.0f}s after {fail_count} failed poll(s)",
+                flush=True
+            )
+        time.sleep(max(0.0, delay))
 
 
 if __name__ == "__main__":